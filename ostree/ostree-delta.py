@@ -21,14 +21,33 @@ Script to create a static delta bteween 2 ostree repos.
 """
 
 import argparse
+import datetime
+import functools
 import os
 import pathlib
-import shutil
 import subprocess
 import sys
 import warnings
 import tarfile
 
+try:
+    import gi
+
+    gi.require_version("OSTree", "1.0")
+    from gi.repository import Gio, GLib, OSTree
+except (ImportError, ValueError):
+    # libostree bindings aren't installed, use the ostree command instead.
+    OSTree = None
+
+# Commit shas already resolved, keyed on (repo, rev).
+_resolved_revs = {}
+
+# Buffer size for reading captured output, kept small on Windows.
+_PIPE_BUFSIZE = 65536 if os.name != "nt" else 4096
+
+# Set from --verbose.
+_verbose = False
+
 
 def warning_on_one_line(message, category, filename, lineno, file=None, line=None):
     """Format a warning the standard way."""
@@ -47,107 +66,326 @@ def warning(message):
     sys.stderr.flush()
 
 
-def _execute_command(command, timeout=None):
+def _print_verbose(message):
+    # Print diagnostics only when --verbose is given.
+    if _verbose:
+        print(message)
+
 
-    print(command)
-    p = subprocess.Popen(
+def _start_command(command, capture=False):
+
+    _print_verbose(command)
+    if not capture:
+        # Let the child write straight to our stderr, and stdout if verbose.
+        stdout = None if _verbose else subprocess.DEVNULL
+        return subprocess.Popen(command, stdin=subprocess.PIPE, stdout=stdout)
+
+    return subprocess.Popen(
         command,
         stdin=subprocess.PIPE,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
-        bufsize=-1,
+        bufsize=_PIPE_BUFSIZE,
         universal_newlines=True,
     )
+
+
+def _wait_for_command(p, timeout=None):
+
     try:
         output, error = p.communicate(timeout=timeout)
     except subprocess.TimeoutExpired:
-        ExecuteHelper._print("Timed out after {}s".format(timeout))
+        warning("Timed out after {}s".format(timeout))
         p.kill()
         output, error = p.communicate()
 
-    print(error)
+    # Always show the errors of a failed command.
+    if error and (_verbose or p.returncode != 0):
+        print(error, file=sys.stderr)
 
     return output
 
 
+def _execute_command(command, timeout=None, capture=False):
+    """
+    Run a command and wait for it to finish.
+
+    Args:
+    * command (list): command and its arguments.
+    * timeout (int): seconds to wait before killing the command.
+    * capture (bool): return stdout as a string. Otherwise the output goes
+      straight to the terminal with --verbose, and None is returned.
+
+    """
+    return _wait_for_command(_start_command(command, capture), timeout=timeout)
+
+
+@functools.lru_cache(maxsize=None)
+def _open_repo(repo):
+    # Open a repo with libostree once and reuse it for every later call.
+    ostree_repo = OSTree.Repo.new(Gio.File.new_for_path(str(repo)))
+    ostree_repo.open(None)
+    return ostree_repo
+
+
 def _determine_machine_from_repo(repo):
 
     # Get the refs from the repo, and discard the ones that start "ostree".
     # This is so we can auto-detect the machine tyoe from the repo, which
     # is important for when the repo comes from a compile wic file.
 
-    command = ["ostree", "--repo={}".format(repo), "refs"]
-    output = _execute_command(command).rstrip().splitlines()
-
-    machine = None
+    if OSTree is not None:
+        _, refs = _open_repo(repo).list_refs(None, None)
+        output = sorted(refs)
+    else:
+        refs = None
+        command = ["ostree", "--repo={}".format(repo), "refs"]
+        output = _execute_command(command, capture=True).splitlines()
+
+    # Take the first ref that doesn't start with "ostree". This will be the
+    # base repo.
+    output = [ref for ref in output if not ref.startswith("ostree")]
+    if len(output) == 0:
+        return None
 
-    # Search through the refs and take the first one that doesn't start
-    # with "ostree". This will be the base repo.
-    for ref in output:
-        if not ref.startswith("ostree"):
-            machine = ref
-            break
+    machine = output[0]
+    if refs is not None:
+        # libostree already gave us the tip, so save rev-parsing the tip and
+        # its parent later on.
+        parent = OSTree.commit_get_parent(_load_commit(repo, refs[machine]))
+        _resolved_revs[(str(repo), machine)] = refs[machine]
+        _resolved_revs[(str(repo), "{}^".format(machine))] = parent
     return machine
 
 
-def _get_data_from_repo(repo, machine, data):
-    # Get the data from the repo
+def _popen_rev_parse(repo, rev):
+    # Start resolving a ref (or sha) to a commit sha.
+    command = ["ostree", "--repo={}".format(repo), "rev-parse", rev]
+    return _start_command(command, capture=True)
 
-    values = []
 
-    command = ["ostree", "--repo={}".format(repo), "log", machine]
-    output = _execute_command(command).rstrip().splitlines()
-    for line in output:
+def _is_sha(rev):
+    # A full commit sha is 64 lower case hex characters.
+    return len(rev) == 64 and all(c in "0123456789abcdef" for c in rev)
 
-        if line.startswith(data):
-            #Date variable requires specific parsing since it contains spaces and colons
-            if data == "Date":
-                values.append(line.split(":", 1)[1].strip())
-            else:
-                values.append(line.split()[1])
-    if len(values) > 0:
-        return values
+
+def _resolve_rev(repo, rev):
+    # Resolve a ref (or sha) to a commit sha with libostree.
+    try:
+        _, sha = _open_repo(repo).resolve_rev(rev, True)
+    except GLib.Error:
+        # e.g. "ref^" when the commit has no parent.
+        sha = None
+    return sha
+
+
+def _rev_parse_in_repos(*revs):
+    """
+    Resolve refs (or shas) to commit shas.
+
+    Uses libostree when available, otherwise the ostree calls run concurrently.
+    Results are cached so each rev is only resolved once, and full shas are
+    returned as they are.
+
+    Args:
+    * revs (tuple): (repo, rev) pairs to resolve.
+
+    Returns the shas in the same order, None for a rev that doesn't exist.
+
+    """
+    for repo, rev in revs:
+        if _is_sha(rev):
+            _resolved_revs[(str(repo), rev)] = rev
+
+    missing = [
+        (repo, rev) for repo, rev in revs if (str(repo), rev) not in _resolved_revs
+    ]
+
+    if OSTree is not None:
+        shas = [_resolve_rev(repo, rev) for repo, rev in missing]
     else:
-        return None
+        processes = [_popen_rev_parse(repo, rev) for repo, rev in missing]
+
+        shas = []
+        for p in processes:
+            output = _wait_for_command(p).strip()
+            if len(output) > 0:
+                shas.append(output)
+            else:
+                shas.append(None)
+
+    for (repo, rev), sha in zip(missing, shas):
+        _resolved_revs[(str(repo), rev)] = sha
+
+    return [_resolved_revs[(str(repo), rev)] for repo, rev in revs]
+
+
+def _rev_parse_in_repo(repo, rev):
+    # Resolve a ref (or sha) to a commit sha. Returns None if it doesn't exist.
+    return _rev_parse_in_repos((repo, rev))[0]
+
+
+def _show_metadata_key(repo, rev, key):
+    # Get a single metadata value from a commit, printed as a GVariant.
+    command = [
+        "ostree",
+        "--repo={}".format(repo),
+        "show",
+        "--print-metadata-key",
+        key,
+        rev,
+    ]
+    return _execute_command(command, capture=True).strip()
+
+
+def _load_commit(repo, rev):
+    # Load a commit object with libostree.
+    _, commit = _open_repo(repo).load_variant(OSTree.ObjectType.COMMIT, rev)
+    return commit
 
 
 def _get_shas_from_repo(repo, machine):
-    # Get the sha from the repo
-    return _get_data_from_repo(repo, machine, "commit")
+    # Get every sha in the history of the ref. This walks the whole log, so
+    # it is only used to validate a sha given on the command line.
+    if OSTree is not None:
+        shas = []
+        ostree_repo = _open_repo(repo)
+        sha = _rev_parse_in_repo(repo, machine)
+        while sha is not None:
+            shas.append(sha)
+            # Stop where the history hasn't been pulled into the repo.
+            _, commit = ostree_repo.load_variant_if_exists(
+                OSTree.ObjectType.COMMIT, sha
+            )
+            sha = OSTree.commit_get_parent(commit) if commit else None
+        return shas
+
+    command = ["ostree", "--repo={}".format(repo), "log", machine]
+    output = _execute_command(command, capture=True).splitlines()
+    return [line.split(maxsplit=1)[1] for line in output if line.startswith("commit")]
 
 
-def _get_version_from_repo(repo, machine):
-    # Get the version from the repo
-    return _get_data_from_repo(repo, machine, "Version")
+def _check_shas_in_repo(repo, machine, *shas):
+    # Exit if a sha given on the command line isn't in the history of the ref.
+    shas = [sha for sha in shas if sha is not None]
+    if len(shas) == 0:
+        return
+
+    history = _get_shas_from_repo(repo, machine)
+    for sha in shas:
+        if sha not in history:
+            warning("sha {} not found in {} for ref {}".format(sha, repo, machine))
+            exit(1)
+
+
+def _get_version_from_repo(repo, rev):
+    # Get the version of a commit. The GVariant string is single quoted.
+    if OSTree is not None:
+        return _load_commit(repo, rev)[0].get("version")
+    return _show_metadata_key(repo, rev, "version").strip("'")
+
+
+def _get_date_from_repo(repo, rev):
+    # Get the date of a commit, in the same format as "ostree log".
+    if OSTree is not None:
+        timestamp = OSTree.commit_get_timestamp(_load_commit(repo, rev))
+        date = datetime.datetime.utcfromtimestamp(timestamp)
+        return date.strftime("%Y-%m-%d %H:%M:%S +0000")
+
+    command = ["ostree", "--repo={}".format(repo), "show", rev]
+    output = _execute_command(command, capture=True).splitlines()
+    # Date requires specific parsing since it contains spaces and colons
+    dates = (
+        line.split(":", 1)[1].strip() for line in output if line.startswith("Date")
+    )
+    return next(dates, None)
+
+
+def _transfer_sha_between_repos(repo, update_repo, sha):
+    # Pull a commit from the update repo into the deployed repo.
+    if OSTree is not None:
+        options = GLib.Variant("a{sv}", {"refs": GLib.Variant("as", [sha])})
+        _open_repo(repo).pull_with_options(
+            "file://{}".format(update_repo), options, None, None
+        )
+        return
+
+    command = [
+        "ostree",
+        "--repo={}".format(repo),
+        "pull-local",
+        update_repo,
+        sha,
+    ]
+    _execute_command(command)
+
+
+def _generate_static_delta(repo, machine, output_filename, from_sha, to_sha):
+    # Generate the static delta.
+    # the max-chunk-size gives the delta in a single data file, called 0
+    if OSTree is not None:
+        params = GLib.Variant(
+            "a{sv}",
+            {
+                "min-fallback-size": GLib.Variant("u", 0),
+                "max-chunk-size": GLib.Variant("u", 2048),
+                "bsdiff-enabled": GLib.Variant("b", True),
+                "filename": GLib.Variant.new_bytestring(
+                    os.fsencode(output_filename)
+                ),
+            },
+        )
+        _open_repo(repo).static_delta_generate(
+            OSTree.StaticDeltaGenerateOpt.MAJOR, from_sha, to_sha, None, params, None
+        )
+        return
+
+    command = [
+        "ostree",
+        "--repo={}".format(repo),
+        "static-delta",
+        "generate",
+        machine,
+        "--max-chunk-size=2048",
+        "--min-fallback-size=0",
+        "--filename={}".format(output_filename),
+        "--from",
+        from_sha,
+        "--to",
+        to_sha,
+    ]
+    _execute_command(command)
 
-def _get_date_from_repo(repo, machine):
-    # Get the date from the repo
-    return _get_data_from_repo(repo, machine, "Date")
 
 def _generate_metadata(outputpath, from_sha, to_sha):
     # Save the from and to shas into a file. They will be needed on the device at the deploy stage.
-    with open(os.path.join(outputpath, "metadata"), "w") as metafile:
+    with open(outputpath / "metadata", "w") as metafile:
         metafile.write("From-sha:{}\n".format(from_sha))
         metafile.write("To-sha:{}\n".format(to_sha))
 
 
-def _generate_tarball(outputpath):
+def _generate_tarball(outputpath, filename):
+    """
+    Create a gzipped tarball of the output folder.
 
-    command = [
-        "tar",
-        "-cf",
-        "{}/data.tar".format(outputpath),
-        "--directory",
-        outputpath,
-        "--exclude=./data.tar",
-        ".",
-    ]
-    output = _execute_command(command)
-    print(output)
+    The delta is already compressed, so level 1 costs little in size.
+
+    Args:
+    * outputpath (Path): output folder, and the contents of the tarball.
+    * filename   (str): name of the tarball within the output folder.
+
+    """
+    tarball = outputpath / filename
+    arcname = "./{}".format(filename)
+    _print_verbose("Creating {}".format(tarball))
+
+    def exclude_tarball(tarinfo):
+        if tarinfo.name == arcname:
+            return None
+        return tarinfo
 
-    command = ["gzip", "--force", "{}/data.tar".format(outputpath)]
-    output = _execute_command(command)
-    print(output)
+    with tarfile.open(tarball, "w:gz", compresslevel=1) as tar:
+        tar.add(outputpath, arcname=".", filter=exclude_tarball)
 
 
 def _generate_static_delta_between_repos(
@@ -167,98 +405,56 @@ def _generate_static_delta_between_repos(
 
     """
 
-    # Get the sha from the new repo
-    shas = _get_shas_from_repo(update_repo, machine)
-
-    if update_sha is None:
-        update_sha = shas[0]
-    else:
-        if update_sha not in shas:
-            warning(
-                "sha {} not found in {} for ref {}".format(
-                    update_sha, update_repo, machine
-                )
-            )
-            exit(1)
-
-    print(update_sha)
+    repo_arg = "--repo={}".format(repo)
 
-    date = _get_date_from_repo(update_repo, machine)
+    _check_shas_in_repo(update_repo, machine, update_sha)
+    _check_shas_in_repo(repo, machine, from_sha)
 
-    versions = _get_version_from_repo(update_repo, machine)
+    # Get the shas from the new and deployed repos together.
+    update_sha, from_sha = _rev_parse_in_repos(
+        (update_repo, update_sha or machine), (repo, from_sha or machine)
+    )
 
-    # Get the sha from the deployed repo
-    shas = _get_shas_from_repo(repo, machine)
+    _print_verbose(update_sha)
+    _print_verbose(from_sha)
 
-    if from_sha is None:
-        from_sha = shas[0]
-    else:
-        if from_sha not in shas:
-            warning("sha {} not found in {} for ref {}".format(from_sha, repo, machine))
-            exit(1)
+    date = _get_date_from_repo(update_repo, update_sha)
 
-    print(from_sha)
+    version = _get_version_from_repo(update_repo, update_sha)
 
     # Pull the new repo into the old repo.
-    command = [
-        "ostree",
-        "--repo={}".format(repo),
-        "pull-local",
-        "{}".format(update_repo),
-        update_sha,
-    ]
-    output = _execute_command(command)
-    print(output)
+    _transfer_sha_between_repos(repo, update_repo, update_sha)
 
     # And commit it.
     command = [
         "ostree",
-        "--repo={}".format(repo),
+        repo_arg,
         "commit",
         "-b",
         machine,
         "-s",
         '"{}"'.format(commit),
-        "--add-metadata-string=version={}".format(versions[0]),
+        "--add-metadata-string=version={}".format(version),
         "--tree=ref={}".format(update_sha),
-        "--timestamp={}".format(date[0]),
+        "--timestamp={}".format(date),
     ]
-    commit_sha = _execute_command(command).rstrip()
-    print(commit_sha)
+    commit_sha = _execute_command(command, capture=True).rstrip()
+    _print_verbose(commit_sha)
+
+    # The commit moved the ref, so forget what it used to resolve to.
+    _resolved_revs.clear()
 
     _generate_metadata(outputpath, from_sha, commit_sha)
 
-    command = ["ostree", "--repo={}".format(repo), "summary", "-u"]
-    output = _execute_command(command)
-    print(output)
+    command = ["ostree", repo_arg, "summary", "-u"]
+    _execute_command(command)
 
-    output_filename = os.path.join(outputpath, "superblock")
+    output_filename = outputpath / "superblock"
 
-    # Generate the static delta.
-    # the max-chunk-size gives the delta in a single data file, called 0
-    command = [
-        "ostree",
-        "--repo={}".format(repo),
-        "static-delta",
-        "generate",
-        machine,
-        "--max-chunk-size=2048",
-        "--min-fallback-size=0",
-        "--filename={}".format(output_filename),
-        "--from",
-        from_sha,
-        "--to",
-        commit_sha,
-    ]
-    output = _execute_command(command)
-    print(output)
-
-    command = ["ostree", "--repo={}".format(repo), "summary", "-u"]
-    output = _execute_command(command)
-    print(output)
+    _generate_static_delta(repo, machine, output_filename, from_sha, commit_sha)
 
-    # Create a tarball.
-    _generate_tarball(outputpath)
+    command = ["ostree", repo_arg, "summary", "-u"]
+    _execute_command(command)
 
 
 def _generate_static_delta_between_shas(repo, outputpath, machine, to_sha, from_sha):
@@ -274,51 +470,22 @@ def _generate_static_delta_between_shas(repo, outputpath, machine, to_sha, from_
 
     """
 
-    shas = _get_shas_from_repo(repo, machine)
+    _check_shas_in_repo(repo, machine, to_sha, from_sha)
 
-    if len(shas) < 2:
-        warning("Not enough commits found is {}".format(repo))
-        exit(1)
-
-    if to_sha is None:
-        to_sha = shas[0]
-    else:
-        if to_sha not in shas:
-            warning("sha {} not found in {} for ref {}".format(to_sha, repo, machine))
-            exit(1)
+    # Default to the tip of the ref and its parent.
+    to_sha, from_sha = _rev_parse_in_repos(
+        (repo, to_sha or machine), (repo, from_sha or "{}^".format(machine))
+    )
 
     if from_sha is None:
-        from_sha = shas[1]
-    else:
-        if from_sha not in shas:
-            warning("sha {} not found in {} for ref {}".format(from_sha, repo, machine))
-            exit(1)
+        warning("Not enough commits found is {}".format(repo))
+        exit(1)
 
     _generate_metadata(outputpath, from_sha, to_sha)
 
-    output_filename = os.path.join(outputpath, "superblock")
-
-    # Generate the static delta.
-    # the max-chunk-size gives the delta in a single data file, called 0
-    command = [
-        "ostree",
-        "--repo={}".format(repo),
-        "static-delta",
-        "generate",
-        machine,
-        "--max-chunk-size=2048",
-        "--min-fallback-size=0",
-        "--filename={}".format(output_filename),
-        "--from",
-        from_sha,
-        "--to",
-        to_sha,
-    ]
-    output = _execute_command(command)
-    print(output)
+    output_filename = outputpath / "superblock"
 
-    # Create a tarball.
-    _generate_tarball(outputpath)
+    _generate_static_delta(repo, machine, output_filename, from_sha, to_sha)
 
 
 def _str_to_resolved_path(path_str):
@@ -410,6 +577,14 @@ def _parse_args():
         required=False,
     )
 
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="Print the commands being run and their output",
+        default=False,
+        required=False,
+    )
+
     args, unknown = parser.parse_known_args()
 
     if len(unknown) > 0:
@@ -422,9 +597,12 @@ def _parse_args():
 
 def main():
     """Script entry point."""
+    global _verbose
+
     warnings.formatwarning = warning_on_one_line
 
     args = _parse_args()
+    _verbose = args.verbose
 
     os.makedirs(args.output, exist_ok=True)
 
@@ -434,7 +612,7 @@ def main():
         machine = args.machine
 
     if args.update_repo is None:
-        print(_generate_static_delta_between_shas)
+        _print_verbose(_generate_static_delta_between_shas)
         _generate_static_delta_between_shas(
             repo=args.repo,
             outputpath=args.output,
@@ -443,7 +621,7 @@ def main():
             from_sha=args.from_sha,
         )
     else:
-        print(_generate_static_delta_between_repos)
+        _print_verbose(_generate_static_delta_between_repos)
         _generate_static_delta_between_repos(
             repo=args.repo,
             update_repo=args.update_repo,
@@ -454,16 +632,12 @@ def main():
             from_sha=args.from_sha,
         )
 
+    # Create a tarball. It is named .bin on request to avoid a "feature" with
+    # manifest generation.
     if args.generate_bin:
-        # Rename the tar-gz file to .bin to avoid a "feature" with manifest generation.
-        command = [
-            "mv",
-            "{}/data.tar.gz".format(args.output),
-            "{}/data.bin".format(args.output),
-        ]
-        output = _execute_command(command)
-        print(output)
-
+        _generate_tarball(args.output, "data.bin")
+    else:
+        _generate_tarball(args.output, "data.tar.gz")
 
 if __name__ == "__main__":
     sys.exit(main())